@@ -10,9 +10,13 @@ MODELO C — BASE HISTÓRICA LOCAL (PARQUET) + INCREMENTAL
 - Logs detalhados de progresso
 """
 
-import os, json, time
+import os, json, time, hashlib, threading
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from pathlib import Path
 from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
 import requests
 from requests.adapters import HTTPAdapter
@@ -21,6 +25,11 @@ from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 import logging
 
+try:
+    import orjson
+except ImportError:  # opcional: sem orjson usa o json da stdlib
+    orjson = None
+
 # ===================== CONFIG =====================
 CF_EMAIL = os.getenv("CF_EMAIL")
 CF_SENHA = os.getenv("CF_SENHA")
@@ -35,15 +44,21 @@ OUTPUT_DIR.mkdir(exist_ok=True)
 
 BASE_PARQUET = OUTPUT_DIR / "base_status.parquet"
 LAST_RUN_PATH = OUTPUT_DIR / "last_run.txt"
+DEXPARA_CACHE = OUTPUT_DIR / "dexpara_mapa.json"
+DEXPARA_VERSAO_PATH = OUTPUT_DIR / "dexpara_versao.txt"
 
 DEXPARA_XLSX_PATH = os.getenv("DEXPARA_XLSX_PATH")
 DEXPARA_SHEET = "TRANSPORTADORA"
+# calamine (Rust) le o xlsx bem mais rapido que o openpyxl; sem ele o pandas usa o padrao
+DEXPARA_ENGINE = "calamine" if importlib.util.find_spec("python_calamine") else None
 
 BASE_URL = "https://utilities.confirmafacil.com.br"
 LOGIN_URL = f"{BASE_URL}/login/login"
 OCORR_URL = f"{BASE_URL}/filter/ocorrencia"
 
-PAGE_SIZE = 1000
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "1000"))
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))
+SHEETS_CHUNK = 10000
 TIMEOUT = (5, 120)
 
 DEBUG = os.getenv("DEBUG", "").lower() in ("1", "true", "yes")
@@ -64,6 +79,11 @@ STATUS_MAP = {
 
 PRIORITY = ["ENTREGUE", "CANCELADO", "DADOS CONFIRMADOS", "CONTATOS CONFIRMADOS"]
 PRIORITY_RANK = {s: i for i, s in enumerate(PRIORITY)}
+
+# codigo (0..999) -> rank de prioridade; -1 = codigo fora do STATUS_MAP
+RANK_LUT = np.full(1000, -1, dtype=np.int8)
+for _cod, _status in STATUS_MAP.items():
+    RANK_LUT[int(_cod)] = PRIORITY_RANK[_status]
 ALL_CODES = ",".join(STATUS_MAP.keys())
 
 COLS = ["CHAVE", "NUMERO", "SERIE", "TRANSPORTADORA", "STATUS", "DATA_ULTIMA_OCORRENCIA"]
@@ -107,7 +127,9 @@ def make_session():
         status_forcelist=[429, 500, 502, 503, 504],
         allowed_methods={"GET", "POST"}
     )
-    s.mount("https://", HTTPAdapter(max_retries=retries))
+    s.mount("https://", HTTPAdapter(max_retries=retries,
+                                    pool_connections=MAX_WORKERS,
+                                    pool_maxsize=MAX_WORKERS))
     return s
 
 def autenticar(session):
@@ -122,20 +144,31 @@ def autenticar(session):
     logging.info("Autenticação OK.")
     return r.json()["resposta"]["token"]
 
-def fetch_page(session, token, params):
+def _json(r):
+    return orjson.loads(r.content) if orjson else r.json()
+
+_token_lock = threading.Lock()
+
+def fetch_page(session, auth, params):
+    # auth = {"token": ...} compartilhado entre as threads de paginacao
+    token = auth["token"]
     r = session.get(OCORR_URL, headers={"Authorization": token},
                     params=params, timeout=TIMEOUT)
     if r.status_code == 401:
-        logging.warning("Token expirado (401). Reautenticando e repetindo a pagina...")
-        token = autenticar(session)
-        r = session.get(OCORR_URL, headers={"Authorization": token},
+        with _token_lock:
+            # So a primeira thread que pegar o 401 reautentica; as demais reusam o token novo
+            if auth["token"] == token:
+                logging.warning("Token expirado (401). Reautenticando e repetindo a pagina...")
+                auth["token"] = autenticar(session)
+        r = session.get(OCORR_URL, headers={"Authorization": auth["token"]},
                         params=params, timeout=TIMEOUT)
     r.raise_for_status()
-    return r.json(), token
+    return _json(r)
 
 def iter_respostas(session, token, di, df):
     total = 0
     t0 = time.perf_counter()
+    auth = {"token": token}
 
     params = {
         "page": 0,
@@ -147,7 +180,7 @@ def iter_respostas(session, token, di, df):
         "tipoData": "CRIACAO",
     }
 
-    payload, token = fetch_page(session, token, params)
+    payload = fetch_page(session, auth, params)
     respostas = payload.get("respostas", []) or []
     total_pages = int(payload.get("totalPages", 0) or 0)
     if respostas:
@@ -155,18 +188,22 @@ def iter_respostas(session, token, di, df):
         logging.info(f"Pagina 0 coletada | {len(respostas)} ocorrencias | Total parcial {total}")
         yield respostas
 
-    if total_pages <= 0:
-        total_pages = 1
-
-    for page in range(1, total_pages):
-        params["page"] = page
-        payload, token = fetch_page(session, token, params)
-        respostas = payload.get("respostas", []) or []
-        if not respostas:
-            continue
-        total += len(respostas)
-        logging.info(f"Pagina {page} coletada | {len(respostas)} ocorrencias | Total parcial {total}")
-        yield respostas
+    if total_pages > 1:
+        logging.info(f"{total_pages} paginas no total | Buscando as restantes com {MAX_WORKERS} workers")
+        ex = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        try:
+            futs = {ex.submit(fetch_page, session, auth, {**params, "page": page}): page
+                    for page in range(1, total_pages)}
+            for fut in as_completed(futs):
+                respostas = fut.result().get("respostas", []) or []
+                if not respostas:
+                    continue
+                total += len(respostas)
+                logging.info(f"Pagina {futs[fut]} coletada | {len(respostas)} ocorrencias | Total parcial {total}")
+                yield respostas
+        finally:
+            # Em erro, descarta as paginas na fila em vez de esperar todas (ate 120s x retries cada)
+            ex.shutdown(wait=False, cancel_futures=True)
 
     logging.info(f"Coleta finalizada | {total} ocorrencias brutas | {_fmt(time.perf_counter()-t0)}")
 
@@ -177,65 +214,63 @@ def _fmt(s):
     return f"{h:02d}:{m:02d}:{sec:02d}"
 
 # ===================== COLETA =====================
-def coletar_incremental(session, token, di, df):
-    registros = {}
-    for page in iter_respostas(session, token, di, df):
-        for item in page:
-            emb = item.get("embarque", {})
-            chave = emb.get("chave")
-            if not chave:
-                continue
-
-            serie = str(emb.get("serie", ""))
-            if serie == "3":
-                continue
-
-            codigo = str(item.get("tipoOcorrencia", {}).get("codigo", ""))
-            status = STATUS_MAP.get(codigo)
-            if not status:
-                continue
+CAMPOS_API = {
+    "embarque.chave": "CHAVE",
+    "embarque.numero": "NUMERO",
+    "embarque.serie": "SERIE",
+    "embarque.transportadora.nome": "TRANSPORTADORA",
+    "tipoOcorrencia.codigo": "CODIGO",
+    "data": "DATA_ULTIMA_OCORRENCIA",
+}
 
-            data_occ = item.get("data")
-            data_occ_dt = pd.to_datetime(data_occ, errors="coerce")
-            atual = registros.get(chave)
-
-            if not atual:
-                registros[chave] = {
-                    "CHAVE": chave,
-                    "NUMERO": emb.get("numero", ""),
-                    "SERIE": serie,
-                    "TRANSPORTADORA": (emb.get("transportadora") or {}).get("nome", ""),
-                    "STATUS": status,
-                    "DATA_ULTIMA_OCORRENCIA": data_occ,
-                }
-                continue
+def _inteiros(s):
+    # json_normalize promove inteiros com lacunas a float; volta ao inteiro nullable
+    return s.astype("Int64") if pd.api.types.is_float_dtype(s) else s
+
+def _texto(s):
+    return _inteiros(s).astype("string").fillna("").astype(object)
+
+def normalizar_pagina(page):
+    raw = (pd.json_normalize(page)
+             .reindex(columns=list(CAMPOS_API))
+             .rename(columns=CAMPOS_API))
+
+    raw = raw[raw["CHAVE"].notna() & (raw["CHAVE"] != "")].copy()
+    raw["SERIE"] = _texto(raw["SERIE"])
+
+    codigo = pd.to_numeric(raw["CODIGO"], errors="coerce")
+    valido = (codigo.between(0, len(RANK_LUT) - 1) & (codigo == codigo.round())).to_numpy()
+    rank = np.full(len(raw), -1, dtype=np.int8)
+    rank[valido] = RANK_LUT[codigo.to_numpy()[valido].astype(np.int64)]
+    raw["_RANK"] = rank
+    raw = raw[(raw["SERIE"] != "3") & (raw["_RANK"] >= 0)].copy()
+    raw["STATUS"] = np.asarray(PRIORITY, dtype=object)[raw["_RANK"].to_numpy()]
+
+    # Campo ausente/nulo vira None (nunca NA/NaN), como no item.get(); publicar troca por ""
+    numero = _inteiros(raw["NUMERO"]).astype(object)
+    raw["NUMERO"] = numero.where(numero.notna(), None)
+    data = raw["DATA_ULTIMA_OCORRENCIA"].astype(object)
+    raw["DATA_ULTIMA_OCORRENCIA"] = data.where(data.notna(), None)
+    raw["TRANSPORTADORA"] = raw["TRANSPORTADORA"].fillna("")
+    return raw[COLS + ["_RANK"]]
 
-            atual_rank = PRIORITY_RANK[atual["STATUS"]]
-            novo_rank = PRIORITY_RANK[status]
-            if novo_rank < atual_rank:
-                registros[chave] = {
-                    "CHAVE": chave,
-                    "NUMERO": emb.get("numero", ""),
-                    "SERIE": serie,
-                    "TRANSPORTADORA": (emb.get("transportadora") or {}).get("nome", ""),
-                    "STATUS": status,
-                    "DATA_ULTIMA_OCORRENCIA": data_occ,
-                }
-            elif novo_rank == atual_rank:
-                atual_dt = pd.to_datetime(atual.get("DATA_ULTIMA_OCORRENCIA"), errors="coerce")
-                if pd.isna(atual_dt) or (not pd.isna(data_occ_dt) and data_occ_dt > atual_dt):
-                    registros[chave] = {
-                        "CHAVE": chave,
-                        "NUMERO": emb.get("numero", ""),
-                        "SERIE": serie,
-                        "TRANSPORTADORA": (emb.get("transportadora") or {}).get("nome", ""),
-                        "STATUS": status,
-                        "DATA_ULTIMA_OCORRENCIA": data_occ,
-                    }
-
-    df = pd.DataFrame(registros.values(), columns=COLS)
+def coletar_incremental(session, token, di, df):
+    paginas = [normalizar_pagina(page) for page in iter_respostas(session, token, di, df)]
+    if not paginas:
+        logging.info("Após deduplicação: 0 registros únicos por CHAVE")
+        return pd.DataFrame(columns=COLS), pd.NaT
+
+    # Prioridade de status e, no empate, a ocorrencia mais recente: um sort + um drop_duplicates
+    todos = pd.concat(paginas, ignore_index=True)
+    todos["_DT"] = pd.to_datetime(todos["DATA_ULTIMA_OCORRENCIA"], errors="coerce",
+                                  format="ISO8601", cache=True)
+    ultima_occ = todos["_DT"].max()
+    todos = todos.sort_values(["_RANK", "_DT"], ascending=[True, False],
+                              na_position="last", kind="stable")
+
+    df = todos.drop_duplicates(subset="CHAVE", keep="first")[COLS].reset_index(drop=True)
     logging.info(f"Após deduplicação: {len(df)} registros únicos por CHAVE")
-    return df
+    return df, ultima_occ
 
 # ===================== BASE LOCAL =====================
 def carregar_base():
@@ -246,39 +281,103 @@ def carregar_base():
     logging.info("Base histórica inexistente | Criando nova")
     return pd.DataFrame(columns=COLS)
 
+def salvar_base(base, versao_dexpara):
+    # STATUS e TRANSPORTADORA tem poucos valores distintos: dicionario + zstd no Parquet
+    base.astype({"STATUS": "category", "TRANSPORTADORA": "category"}).to_parquet(
+        BASE_PARQUET, index=False, compression="zstd", compression_level=3
+    )
+    DEXPARA_VERSAO_PATH.write_text(versao_dexpara)
+    logging.info(f"Base histórica salva | {len(base)} registros")
+
 def merge_base(base, novo):
     if novo.empty:
         logging.info("Nenhuma atualização incremental para aplicar.")
         return base
 
-    base = base.set_index("CHAVE")
-    novo = novo.set_index("CHAVE")
+    if base.empty:
+        logging.info(f"Merge concluído | Base total agora com {len(novo)} registros")
+        return novo.reset_index(drop=True)
+
+    # Posicional, como o antigo update + append: CHAVEs existentes atualizadas no lugar
+    # (so com valores nao nulos do incremental), CHAVEs novas anexadas no fim.
+    # isin varre a base sem montar hash dela; o get_indexer so indexa o lote incremental.
+    linhas = np.flatnonzero(base["CHAVE"].isin(novo["CHAVE"]).to_numpy())
+    origem = pd.Index(novo["CHAVE"]).get_indexer(base["CHAVE"].iloc[linhas])
+    existe = np.zeros(len(novo), dtype=bool)
+    existe[origem] = True
+
+    categoricas = {c: object for c in base.columns if isinstance(base[c].dtype, pd.CategoricalDtype)}
+    if categoricas:
+        base = base.astype(categoricas)
+
+    if len(linhas):
+        for j, col in enumerate(base.columns):
+            if col == "CHAVE":
+                continue
+            vals = novo[col].to_numpy(dtype=object)[origem]
+            ok = pd.notna(vals)
+            if not ok.any():
+                continue
+            vals = pd.Series(vals[ok]).infer_objects()
+            if vals.dtype == object and base[col].dtype != object:
+                # Upcast explicito (ex.: NUMERO int64 na base x texto no incremental); o pandas 3 nao faz sozinho
+                base[col] = base[col].astype(object)
+            base.iloc[linhas[ok], j] = vals.to_numpy()
 
-    base.update(novo)
-    novos = novo.loc[~novo.index.isin(base.index)]
-    base = pd.concat([base, novos])
+    if not existe.all():
+        base = pd.concat([base, novo[~existe]], ignore_index=True)
 
     logging.info(f"Merge concluído | Base total agora com {len(base)} registros")
-    return base.reset_index()
+    return base
 
 # ===================== DEXPARA =====================
-def aplicar_dexpara(df):
+def carregar_dexpara():
+    # Chave pelo conteudo (nao mtime): o checkout do Actions renova o mtime a cada run
+    versao = hashlib.sha1(Path(DEXPARA_XLSX_PATH).read_bytes()).hexdigest()
+    if DEXPARA_CACHE.exists():
+        try:
+            cache = json.loads(DEXPARA_CACHE.read_text())
+            if cache.get("versao") == versao:
+                logging.info("DExPARA inalterado | Mapa carregado do cache")
+                return cache["mapa"], versao
+        except (ValueError, KeyError) as e:
+            logging.warning(f"Cache do DExPARA ilegivel, relendo o xlsx: {e}")
+
     mapa = pd.read_excel(
         DEXPARA_XLSX_PATH,
         sheet_name=DEXPARA_SHEET,
         usecols=[0, 1],
         header=None,
         names=["O", "N"],
-        dtype=str
+        dtype=str,
+        engine=DEXPARA_ENGINE
     )
     d = {o.strip().upper(): (n or "").strip()
          for o, n in mapa.values if isinstance(o, str)}
 
-    df["TRANSPORTADORA"] = df["TRANSPORTADORA"].map(lambda x: d.get(str(x).upper(), x))
-    logging.info("DExPARA aplicado na transportadora")
+    DEXPARA_CACHE.write_text(json.dumps({"versao": versao, "mapa": d}))
+    logging.info(f"DExPARA lido do xlsx | {len(d)} transportadoras mapeadas")
+    return d, versao
+
+def versao_dexpara_base():
+    # Versao do DExPARA com que a base historica em Parquet ja foi remapeada
+    return DEXPARA_VERSAO_PATH.read_text().strip() if DEXPARA_VERSAO_PATH.exists() else None
+
+def aplicar_dexpara(df, d):
+    # Poucas dezenas de transportadoras distintas: normaliza e mapeia so os valores unicos
+    codes, unicos = pd.factorize(df["TRANSPORTADORA"], use_na_sentinel=False)
+    unicos = pd.Series(unicos, dtype=object)
+    mapped = unicos.astype(str).str.strip().str.upper().map(d)
+    novos = mapped.where(mapped.notna(), unicos)
+    df["TRANSPORTADORA"] = novos.to_numpy()[codes]
+
+    nao_mapeadas = unicos[mapped.isna()].tolist()
+    logging.info(f"DExPARA aplicado na transportadora | {len(nao_mapeadas)} nomes sem mapeamento")
+    logging.debug(f"Transportadoras sem mapeamento: {nao_mapeadas}")
     return df
 
 # ===================== SHEETS =====================
+@lru_cache(maxsize=1)
 def gsheets():
     path = os.getenv("GOOGLE_CREDENTIALS_PATH")
     if not path or not os.path.exists(path):
@@ -288,7 +387,9 @@ def gsheets():
         path,
         scopes=["https://www.googleapis.com/auth/spreadsheets"]
     )
-    return build("sheets", "v4", credentials=creds)
+    # Discovery doc embarcado na lib: sem fetch HTTP nem file_cache
+    return build("sheets", "v4", credentials=creds,
+                 static_discovery=True, cache_discovery=False)
 
 def publicar(df):
     logging.info("Publicando snapshot no Google Sheets (modo overwrite real)...")
@@ -333,21 +434,23 @@ def publicar(df):
         }
     ).execute()
 
-    # 3️⃣ LIMPAR VALORES
-    svc.spreadsheets().values().clear(
-        spreadsheetId=SHEET_ID,
-        range=f"{aba_nome}!A1:E"
-    ).execute()
-
-    # 4️⃣ ESCREVER DE UMA VEZ (overwrite real)
-    values = [df.columns.tolist()] + df.values.tolist()
-
-    svc.spreadsheets().values().update(
-        spreadsheetId=SHEET_ID,
-        range=f"{aba_nome}!A1",
-        valueInputOption="RAW",
-        body={"values": values}
-    ).execute()
+    # 3️⃣ ESCREVER (overwrite real); acima de SHEETS_CHUNK linhas, um update por bloco
+    # para cada requisicao ficar bem abaixo do limite de ~10 MB da API
+    # Sem clear: o resize acima ja cortou as linhas excedentes e o restante e sobrescrito.
+    # Celula nula no ValueRange e pulada (nao apagada), entao todo NA/None vira "" antes de enviar
+    snapshot = df.astype(object).where(df.notna(), "")
+    values = [snapshot.columns.tolist()] + snapshot.values.tolist()
+    blocos = range(0, len(values), SHEETS_CHUNK)
+
+    for i in blocos:
+        svc.spreadsheets().values().update(
+            spreadsheetId=SHEET_ID,
+            range=f"{aba_nome}!A{i + 1}",
+            valueInputOption="RAW",
+            body={"values": values[i:i + SHEETS_CHUNK]}
+        ).execute()
+        if len(blocos) > 1:
+            logging.info(f"Bloco publicado | linhas {i + 1}-{min(i + SHEETS_CHUNK, len(values))} de {len(values)}")
 
     logging.info("Publicação concluída com overwrite real (sem crescimento de células).")
 
@@ -361,15 +464,27 @@ def run():
     sess = make_session()
     token = autenticar(sess)
 
-    df_inc = coletar_incremental(sess, token, di, df)
+    df_inc, ultima_occ = coletar_incremental(sess, token, di, df)
+    mapa, versao = carregar_dexpara()
     base = carregar_base()
+
+    # A base ja esta normalizada: so o incremental passa pelo DExPARA, salvo se o mapa mudou
+    if versao != versao_dexpara_base():
+        logging.info("DExPARA mudou desde a ultima gravacao da base | Remapeando a base inteira")
+        base = aplicar_dexpara(base, mapa)
+    df_inc = aplicar_dexpara(df_inc, mapa)
     base = merge_base(base, df_inc)
-    base = aplicar_dexpara(base)
 
-    base.to_parquet(BASE_PARQUET, index=False)
-    LAST_RUN_PATH.write_text(df.isoformat())
+    # Parquet (disco) e Sheets (rede) so leem a base: rodam em paralelo
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        f_base = ex.submit(salvar_base, base, versao)
+        f_pub = ex.submit(publicar, base)
+        f_base.result()
+        f_pub.result()
 
-    publicar(base)
+    # So registra a execucao depois de base salva E Sheets publicado; usa a data da API, nao o relogio local
+    if pd.notna(ultima_occ):
+        LAST_RUN_PATH.write_text(ultima_occ.isoformat())
 
     logging.info(f"Pipeline FINALIZADO com sucesso | Tempo total {_fmt(time.perf_counter()-t0)}")
 